@@ -0,0 +1,162 @@
+"""
+Local aggregator agent.
+Owns the dump file, so worker processes do not compete for its lock.
+
+Run:
+    python -m ptbappstats.agent --socket /path/to/agent.sock --path /path/to/the/dump/file
+
+Workers send deltas with Stats.push(socket_path) instead of Stats.dump(path).
+The agent merges deltas in memory (see Stats.update_from_historical)
+and dumps them (update=True, purge=True) every --interval seconds.
+"""
+
+import argparse
+import json
+import os
+import signal
+import socket
+import time
+import zlib
+
+from .stats import Stats, StatsEncoder, StatsDecoder, compact_data, expand_data
+
+DELTA_MAGIC = b'PTBS\x01'
+MAX_DELTA_SIZE = 4 * 1024 * 1024
+DATAGRAM_OVERHEAD = 1024  # kernel accounting, kept out of the socket send buffer
+PERSIST_INTERVAL = 60
+
+
+def encode_delta(data: dict) -> bytes:
+    """data: metric name -> registry (see Stats.cast)"""
+    payload = json.dumps(compact_data(data), cls=StatsEncoder, separators=(',', ':'))
+    return DELTA_MAGIC + zlib.compress(payload.encode('utf-8'))
+
+
+def decode_delta(payload: bytes) -> dict:
+    if not payload.startswith(DELTA_MAGIC):
+        raise ValueError('Invalid delta header.')
+    delta = expand_data(json.loads(zlib.decompress(payload[len(DELTA_MAGIC):]).decode('utf-8'), cls=StatsDecoder))
+    validate_delta(delta)
+    return delta
+
+
+def validate_delta(delta):
+    if not isinstance(delta, dict):
+        raise ValueError(f'Invalid delta type: {type(delta)}')
+    for metric_name, metric_data in delta.items():
+        if not isinstance(metric_data, dict):
+            raise ValueError(f'Invalid delta of {metric_name}: {type(metric_data)}')
+
+
+def max_delta_size() -> int:
+    """the largest datagram a unix socket can send, bounded by MAX_DELTA_SIZE"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        send_buffer = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+    return min(send_buffer, MAX_DELTA_SIZE) - DATAGRAM_OVERHEAD
+
+
+def split_delta(data: dict, max_size: int) -> list:
+    """
+    Returns [(data chunk, encoded delta)], data is split by function entries
+    until each encoded delta fits max_size bytes.
+    Raises ValueError if a single function entry does not fit.
+    """
+    payload = encode_delta(data)
+    if len(payload) <= max_size:
+        return [(data, payload)]
+    entries = [(metric_name, fn, v) for metric_name, metric_data in data.items() for fn, v in metric_data.items()]
+    if len(entries) < 2:
+        raise ValueError(f'Delta of {entries[0][:2] if entries else data} exceeds {max_size} bytes.')
+    chunks = []
+    for part in (entries[:len(entries) // 2], entries[len(entries) // 2:]):
+        chunk = {}
+        for metric_name, fn, v in part:
+            chunk.setdefault(metric_name, {})[fn] = v
+        chunks.extend(split_delta(chunk, max_size))
+    return chunks
+
+
+def send_delta(socket_path: str, payload: bytes) -> bool:
+    """
+    Sends a single datagram without blocking.
+    Returns False if the agent is not running, its queue is full or the delta is too large.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        try:
+            sock.sendto(payload, socket.MSG_DONTWAIT, socket_path)
+        except OSError:
+            return False
+    return True
+
+
+class Agent:
+
+    def __init__(self, socket_path: str, path: str, interval: float = PERSIST_INTERVAL):
+        self.socket_path = socket_path
+        self.path = path
+        self.interval = interval
+        self.stats = Stats()
+        self.dirty = False
+        self._running = False
+
+    def merge(self, delta: dict):
+        Stats()._merge_dict(delta)  # dry run, a malformed delta raises before anything is merged
+        self.stats._merge_dict(delta)
+        self.dirty = True
+        return self
+
+    def persist(self):
+        if self.dirty:
+            self.stats.dump(self.path, update=True, purge=True)
+            self.dirty = False
+        return self
+
+    def stop(self, *args):
+        self._running = False
+
+    def serve(self):
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, MAX_DELTA_SIZE)
+            sock.bind(self.socket_path)
+            self._running = True
+            next_persist = time.monotonic() + self.interval
+            try:
+                while self._running:
+                    # short timeouts keep the loop responsive to stop()
+                    sock.settimeout(min(max(next_persist - time.monotonic(), 0.01), 1.0))
+                    try:
+                        payload = sock.recv(MAX_DELTA_SIZE)
+                    except socket.timeout:
+                        payload = None
+                    if payload:
+                        try:
+                            self.merge(decode_delta(payload))
+                        except Exception:
+                            pass  # malformed delta, one bad worker must not stop aggregation
+                    if time.monotonic() >= next_persist:
+                        self.persist()
+                        next_persist = time.monotonic() + self.interval
+            finally:
+                self.persist()
+                os.unlink(self.socket_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ptbappstats.agent', description=__doc__.split('\n')[1])
+    parser.add_argument('--socket', required=True, help='unix socket path workers push deltas to')
+    parser.add_argument('--path', required=True, help='dump file path')
+    parser.add_argument('--interval', type=float, default=PERSIST_INTERVAL, help='seconds between dumps')
+    args = parser.parse_args(argv)
+
+    agent = Agent(args.socket, args.path, args.interval)
+    signal.signal(signal.SIGTERM, agent.stop)
+    signal.signal(signal.SIGINT, agent.stop)
+    agent.serve()
+
+
+if __name__ == '__main__':
+    main()
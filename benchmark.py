@@ -0,0 +1,59 @@
+"""
+Stats.serialize snapshot benchmark.
+
+Fills Count and Performance registries with many functions, then changes `changed` Count keys
+(through Count handles, which mark them dirty) before each timed Stats.serialize call.
+Prints the mean snapshot time per number of changed keys - with the fragment cache
+it grows with the changed keys, and barely with the registry size (compare runs with different --functions).
+
+Run:
+    python -m ptbappstats.benchmark --functions 100000 --changed 0 10 100 1000 10000
+"""
+
+import argparse
+import time
+
+from .stats import Stats
+from .metrics.time_metrics import PerformanceData
+
+
+def filled_stats(functions: int) -> Stats:
+    stats = Stats()
+    for i in range(functions):
+        fn_name = f'package.module.Class.method_{i}'
+        stats.Count.registry[fn_name] += i
+        stats.Performance.registry[fn_name] = PerformanceData(i + 1, 0.001 * i, 0.001 * i / (i + 1))
+    return stats
+
+
+def snapshot_time(stats: Stats, changed: int, repeat: int = 5) -> float:
+    """mean seconds of a serialize call after changing `changed` keys"""
+    handles = [stats.Count.handle(fn_name) for fn_name in list(stats.Count.registry)[:changed]]
+    total = 0.
+    for _ in range(repeat):
+        for handle in handles:
+            handle.add()
+        t0 = time.perf_counter()
+        stats.serialize()
+        total += time.perf_counter() - t0
+    return total / repeat
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ptbappstats.benchmark', description=__doc__.split('\n')[1])
+    parser.add_argument('--functions', type=int, default=100_000, help='registry size')
+    parser.add_argument('--changed', type=int, nargs='*', default=[0, 10, 100, 1_000, 10_000],
+                        help='changed keys between snapshots')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    stats = filled_stats(args.functions)
+    t0 = time.perf_counter()
+    stats.serialize()
+    print(f'functions: {args.functions}, first (full) snapshot: {time.perf_counter() - t0:.6f} s')
+    for changed in args.changed:
+        print(f'changed: {changed:>8}, snapshot: {snapshot_time(stats, changed, args.repeat):.6f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,15 @@
 
 import inspect
+import sys
 from collections import defaultdict
 from functools import wraps
 from typing import Protocol, Any
 from typing import TypeVar
 from itertools import dropwhile
 
+import numpy as np
+import pandas as pd
+
 
 def validate_other_same_class(self, other):
     if not isinstance(other, self.__class__):
@@ -26,6 +30,92 @@ def fn_name_template(fn):
         return '.'.join((fn.__module__, fn.__name__))
 
 
+class KeyTable:
+    """
+    Interned keys shared by all metrics of a Stats instance.
+    Each key is stored once, so all registries hold the same key objects (with cached hashes).
+    Key ids (positions in names) are used by the compact dump format.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+
+    def intern(self, name: str) -> str:
+        try:
+            return self.names[self.ids[name]]
+        except KeyError:
+            name = sys.intern(name)
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+            return name
+
+    def id(self, name: str) -> int:
+        return self.ids[self.intern(name)]
+
+    def resolver(self, fn):
+        """
+        Returns a callable (args -> interned function name).
+        The name template is formatted once per class, not on each call.
+        """
+        template = fn_name_template(fn)
+        if '{}' not in template:
+            fn_name = self.intern(template)
+            return lambda args: fn_name
+
+        fn_names = {}
+
+        def resolve(args):
+            cls_name = pull_self(args)
+            try:
+                return fn_names[cls_name]
+            except KeyError:
+                fn_name = fn_names[cls_name] = self.intern(template.format(cls_name))
+                return fn_name
+        return resolve
+
+    def __len__(self):
+        return len(self.names)
+
+
+OVERFLOW_LABEL = '__overflow__'
+LABEL_SEPARATOR = '|'
+MAX_LABELS = 100
+LABEL_CACHE_SIZE = 1024  # label tuples cached per Labeler
+
+
+class Labeler:
+    """
+    Turns label extractor output (a tuple of labels) into an interned label key - labels joined with LABEL_SEPARATOR.
+    extractor(args, kwargs, result) is called with the decorated function call arguments and result.
+    Once a table holds max_labels keys, new labels are folded into OVERFLOW_LABEL.
+    The cap is checked against the given table on each call (tables are purged and may be shared by classes).
+    """
+    def __init__(self, extractor, key_table: KeyTable, max_labels: int = MAX_LABELS):
+        self.extractor = extractor
+        self.key_table = key_table
+        self.max_labels = max_labels
+        self._keys = {}  # labels -> key (overflowed labels included), bounded by LABEL_CACHE_SIZE
+
+    def __call__(self, table: dict, args, kwargs, result) -> str:
+        labels = self.extractor(args, kwargs, result)
+        if not isinstance(labels, tuple):
+            labels = (labels,)
+        try:
+            key = self._keys[labels]
+        except KeyError:
+            key = LABEL_SEPARATOR.join(map(str, labels))
+            if len(self._keys) < LABEL_CACHE_SIZE:
+                self._keys[labels] = key
+        if key in table:
+            return key
+        if len(table) >= self.max_labels:
+            return OVERFLOW_LABEL
+        key = self.key_table.intern(key)
+        if labels in self._keys:
+            self._keys[labels] = key
+        return key
+
+
 def zero():
     return 0
 
@@ -34,6 +124,30 @@ def fn_name_abbr(fn_name: str):
     return '.'.join(dropwhile(lambda x: x.startswith('_'), fn_name.split('.')))
 
 
+def factorize_fn_names(fn_names, size: int = 1):
+    """
+    Returns (codes, uniques) for an array of function names.
+    A single name (str) is broadcast to size.
+    """
+    if isinstance(fn_names, str):
+        return np.zeros(size, dtype=np.int64), [fn_names]
+    codes, uniques = pd.factorize(np.asarray(fn_names, dtype=object))
+    return codes.astype(np.int64), list(uniques)
+
+
+def as_datetime64(timestamps) -> np.ndarray:
+    """missing timestamps (None) become NaT"""
+    timestamps = np.asarray(timestamps)
+    if timestamps.dtype.kind != 'M':
+        timestamps = timestamps.astype('datetime64[ns]')
+    return timestamps
+
+
+def validate_ingest_lengths(codes, timestamps):
+    if len(codes) != len(timestamps):
+        raise ValueError(f'fn_names length ({len(codes)}) does not match timestamps length ({len(timestamps)})')
+
+
 MetricType = TypeVar('MetricType')
 
 
@@ -66,6 +180,7 @@ class Metric:
         """must instantiate self._registry"""
         ...
         self._registry = None
+        self.key_table = KeyTable()  # replaced by the shared Stats.key_table
 
     @property
     def registry(self):
@@ -98,12 +213,41 @@ class Metric:
         return f'{self.__class__.__name__}: {self.registry}'
 
 
-class DictOfNumericsRegistry(defaultdict):
+class DirtyKeysMixin:
+    """
+    Tracks keys changed since the last take_dirty() (see Stats.serialize cache).
+    Registry writes stay plain dict writes: metric write paths add the written key to `dirty` after the write
+    (a plain set.add), registry methods (update_from_historical, purge) mark the keys they change.
+    Only primary registries are tracked (see track), nested table changes are marked under their owner key.
+    """
+    dirty = None  # set of changed keys, None if not tracked
+
+    def track(self):
+        self.dirty = set()
+        return self
+
+    def mark_dirty(self, keys):
+        if self.dirty is not None:
+            self.dirty.update(keys)
+
+    def take_dirty(self) -> set:
+        """
+        Pops changed keys one by one, so keys marked meanwhile by other threads are not lost.
+        The dirty set is emptied in place, so bound dirty.add methods (see handles) stay valid.
+        """
+        dirty, taken = self.dirty, set()
+        while dirty:
+            taken.add(dirty.pop())
+        return taken
+
+
+class DictOfNumericsRegistry(DirtyKeysMixin, defaultdict):
 
     def update_from_historical(self, historical):
         validate_other_same_class(self, historical)
         for k, v in historical.items():
             self[k] += v
+        self.mark_dirty(historical)
 
     def cast(self):
         return dict(self)
@@ -112,12 +256,13 @@ class DictOfNumericsRegistry(defaultdict):
         keys = tuple(self.keys())
         for k in keys:
             del self[k]
+        self.mark_dirty(keys)
 
     def __repr__(self):
         return f'{self.__class__.__name__} :{self.cast()}'
 
 
-class DictOfDictRegistry(dict):
+class DictOfDictRegistry(DirtyKeysMixin, dict):
     def __setitem__(self, key, value) -> None:
         if not isinstance(key, str):
             raise TypeError(f'Illegal key type {type(key)}. Key must be string.')
@@ -138,10 +283,12 @@ class DictOfDictRegistry(dict):
                     self[k].update_from_historical(v)
                 else:
                     pass
+        self.mark_dirty(historical)
 
     def purge(self):
         for k, v in self.items():
             v.purge()
+        self.mark_dirty(self)
 
     def cast(self):
         return {k: d.cast() for k, d in self.items()}
@@ -156,15 +303,17 @@ class SingleNestValueMetric(Metric):
 
     def __init__(self) -> None:
         super().__init__()
-        self._registry = self.__class__.PRIMARY_REGISTRY(self.__class__.PRIMARY_REGISTRY_DEFAULT)
+        self._registry = self.__class__.PRIMARY_REGISTRY(self.__class__.PRIMARY_REGISTRY_DEFAULT).track()
 
     def decorator(self, fn):
-        template = fn_name_template(fn)
+        resolve_fn_name = self.key_table.resolver(fn)
 
         @wraps(fn)
         def wrapper(*args, **kwargs):
-            fn_name = template.format(pull_self(args))
-            self.registry[fn_name] += 1
+            fn_name = resolve_fn_name(args)
+            registry = self.registry
+            registry[fn_name] += 1
+            registry.dirty.add(fn_name)
 
             return fn(*args, **kwargs)
         return wrapper
@@ -192,7 +341,7 @@ class DoubleNestValueMetric(Metric):
 
     def __init__(self):
         super().__init__()
-        self._registry = self.PRIMARY_REGISTRY()
+        self._registry = self.PRIMARY_REGISTRY().track()
 
     def __call__(self, *args, **kwargs):
         """
@@ -1,13 +1,32 @@
 
 from .base_metrics import (DictOfNumericsRegistry, DictOfDictRegistry, SingleNestValueMetric, DoubleNestValueMetric,
-                           zero, pull_self, fn_name_template)
+                           zero, factorize_fn_names, as_datetime64, validate_ingest_lengths, Labeler,
+                           MAX_LABELS)
 from functools import wraps
 
+import numpy as np
+
 
 class CountRegistry(DictOfNumericsRegistry):
     pass
 
 
+class CountHandle:
+    """
+    Pre-bound Count key for hot loops (see Count.handle)
+    """
+    __slots__ = ('registry', 'key', 'mark_dirty')
+
+    def __init__(self, registry, key: str):
+        self.registry = registry
+        self.key = key
+        self.mark_dirty = registry.dirty.add
+
+    def add(self, n: int = 1):
+        self.registry[self.key] += n
+        self.mark_dirty(self.key)
+
+
 class Count(SingleNestValueMetric):
     """
     Counts calls
@@ -15,6 +34,36 @@ class Count(SingleNestValueMetric):
     PRIMARY_REGISTRY = CountRegistry
     PRIMARY_REGISTRY_DEFAULT = lambda: 0
 
+    def handle(self, key: str) -> CountHandle:
+        """
+        Returns a handle counting under key without decorating a function:
+            items = stats.Count.handle('module.items')
+            items.add(len(batch))
+        """
+        return CountHandle(self.registry, self.key_table.intern(key))
+
+    def ingest(self, fn_names, timestamps=None):
+        """
+        Bulk adds calls to the registry (eg. backfilling from access logs).
+        fn_names: array of function names (one per call) or a single name.
+        timestamps: not counted - only used to broadcast a single fn_name
+        and to skip calls with missing (NaT / None) timestamps, as PeriodicBase.ingest does.
+        """
+        if timestamps is None:
+            codes, fn_names = factorize_fn_names(fn_names)
+        else:
+            timestamps = as_datetime64(timestamps)
+            codes, fn_names = factorize_fn_names(fn_names, len(timestamps))
+            validate_ingest_lengths(codes, timestamps)
+            codes = codes[~np.isnat(timestamps)]
+        counts = np.bincount(codes, minlength=len(fn_names))
+        for fn_name, n in zip(fn_names, counts.tolist()):
+            if n:
+                fn_name = self.key_table.intern(fn_name)
+                self.registry[fn_name] += n
+                self.registry.dirty.add(fn_name)
+        return self
+
 
 class CountResultsRegistry(DictOfDictRegistry):
     pass
@@ -41,7 +90,7 @@ class CountResults(DoubleNestValueMetric):
         serialized = serialisation(expected_result)
 
         def decorator(fn):
-            template = fn_name_template(fn)
+            resolve_fn_name = self.key_table.resolver(fn)
 
             @wraps(fn)
             def wrapper(*args, **kwargs):
@@ -49,7 +98,7 @@ class CountResults(DoubleNestValueMetric):
                 if result != expected_result:
                     return result
 
-                fn_name = template.format(pull_self(args))
+                fn_name = resolve_fn_name(args)
 
                 try:
                     count_table = self.registry[fn_name]
@@ -57,6 +106,58 @@ class CountResults(DoubleNestValueMetric):
                     count_table = self.registry[fn_name] = self.__class__.SECONDARY_REGISTRY(self.__class__.SECONDARY_REGITRY_DEFAULT)
 
                 count_table[serialized] += 1
+                self.registry.dirty.add(fn_name)
+                return result
+
+            return wrapper
+        return decorator
+
+    def serialize(self):
+        return self.registry.cast()
+
+
+class CountLabelsRegistry(DictOfDictRegistry):
+    pass
+
+
+class CountLabelsTable(DictOfNumericsRegistry):
+    pass
+
+
+class CountLabels(DoubleNestValueMetric):
+    """
+    Counts calls per label key.
+    labels: callable(args, kwargs, result) returning a tuple of (hashable) labels, eg.:
+        @stats.CountLabels(lambda args, kwargs, result: (kwargs['tenant'], result.status))
+    max_labels: cardinality cap of a function table, excess labels are counted under OVERFLOW_LABEL
+    """
+    PRIMARY_REGISTRY = CountLabelsRegistry
+    SECONDARY_REGISTRY = CountLabelsTable
+    SECONDARY_REGITRY_DEFAULT = zero
+
+    def __call__(self, labels, max_labels: int = MAX_LABELS):
+        if not callable(labels):
+            raise ValueError('Invalid decorator use. Declare a callable label extractor.')
+        return self.decorated_namespace(labels, max_labels)
+
+    def decorated_namespace(self, labels, max_labels):
+
+        def decorator(fn):
+            resolve_fn_name = self.key_table.resolver(fn)
+            labeler = Labeler(labels, self.key_table, max_labels)
+
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                result = fn(*args, **kwargs)
+                fn_name = resolve_fn_name(args)
+
+                try:
+                    count_table = self.registry[fn_name]
+                except KeyError:
+                    count_table = self.registry[fn_name] = self.__class__.SECONDARY_REGISTRY(self.__class__.SECONDARY_REGITRY_DEFAULT)
+
+                count_table[labeler(count_table, args, kwargs, result)] += 1
+                self.registry.dirty.add(fn_name)
                 return result
 
             return wrapper
@@ -66,4 +167,4 @@ class CountResults(DoubleNestValueMetric):
         return self.registry.cast()
 
 
-AVALIABLE = (CountResults, Count)
+AVALIABLE = (CountResults, Count, CountLabels)
@@ -1,4 +1,6 @@
 import multiprocessing
+import os
+import threading
 import time
 from collections import namedtuple
 from functools import wraps
@@ -8,7 +10,7 @@ import numpy as np
 import psutil
 from matplotlib import pyplot as plt
 
-from .base_metrics import SingleNestValueMetric, fn_name_template, validate_other_same_class, pull_self, fn_name_abbr
+from .base_metrics import SingleNestValueMetric, validate_other_same_class, fn_name_abbr
 from .time_metrics import PerformanceRegistry
 
 CPU_MEASURMENT_INTERVAL = 0.1
@@ -23,6 +25,8 @@ class NMeansTupleData:
         validate_other_same_class(self, other)
         current_n = self.n
         other_n = other.n
+        if not current_n + other_n:
+            return self
         current_arr = np.array(self.values)
         other_arr = np.array(other.values)
         length: int = max(len(current_arr), len(other_arr))
@@ -46,6 +50,7 @@ class CPUUseRegistry(PerformanceRegistry):
     def purge(self):
         for k in self.keys():
             self[k] = CPUMeanUseData.null()
+        self.mark_dirty(self)
 
     def cast(self):
         return {k: tuple(v) for k, v in self.items()}
@@ -54,46 +59,140 @@ class CPUUseRegistry(PerformanceRegistry):
         validate_other_same_class(self, historical)
         for k, v in historical.items():
             self[k] = self.get(k, CPUMeanUseData.null()).update_from_historical(v)
+        self.mark_dirty(historical)
 
 
-def cpu_measurment(q, pid, flag):
-    process = [p for p in psutil.process_iter(['pid']) if p.pid == pid][0]
-    while not flag.is_set():
-        q.put(process.cpu_percent(interval=CPU_MEASURMENT_INTERVAL))
+def thread_cpu_clock(ident: int, native_id: int):
+    """
+    Returns a callable giving cpu seconds (user + system) consumed by the thread.
+    Uses the thread cpu clock where available, otherwise per-thread times from psutil (/proc/self/task/<tid>/stat).
+    """
+    try:
+        clock_id = time.pthread_getcpuclockid(ident)
+        return lambda: time.clock_gettime(clock_id)
+    except (AttributeError, OSError):
+        def clock():
+            for thread in psutil.Process().threads():
+                if thread.id == native_id:
+                    return thread.user_time + thread.system_time
+            return 0.
+        return clock
+
+
+class CpuCall:
+    """
+    Sampling state of a monitored call.
+    Samples are due every interval from the call start (start + k * interval).
+    """
+    __slots__ = ('clock', 'last_cpu', 'last_wall', 'next_due', 'last_duration', 'samples')
+
+    def __init__(self, clock, interval: float):
+        self.clock = clock
+        self.last_cpu = clock()
+        self.last_wall = time.perf_counter()
+        self.next_due = self.last_wall + interval
+        self.last_duration = 0.  # wall seconds of the last sample
+        self.samples = []
+
+
+class ThreadCpuSampler:
+    """
+    A single sampler thread serving all CpuUse calls in the process.
+    It samples cpu percent of the threads executing monitored calls, every interval from each call start,
+    so concurrent calls get independent cpu profiles aligned with their start (see CpuUse.plot time axis).
+    The last (partial) sample is taken when the call returns. If it is shorter than
+    MIN_SAMPLE_FRACTION of the interval, it is merged into the previous sample (or dropped if there is none),
+    as percents over very short wall times are not meaningful.
+    The sampler thread stops when there are no monitored calls.
+    """
+    MIN_SAMPLE_FRACTION = 0.25
+
+    def __init__(self, interval: float = CPU_MEASURMENT_INTERVAL):
+        self.interval = interval
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._thread = None
+
+    def start(self) -> CpuCall:
+        """registers the calling thread, returns the call handle for stop"""
+        call = CpuCall(thread_cpu_clock(threading.get_ident(), threading.get_native_id()), self.interval)
+        with self._lock:
+            self._calls[id(call)] = call
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='ptbappstats-cpu-sampler', daemon=True)
+                self._thread.start()
+        return call
+
+    def stop(self, call: CpuCall) -> Tuple[float, ...]:
+        with self._lock:
+            del self._calls[id(call)]
+            cpu, wall = call.clock(), time.perf_counter()
+            duration = wall - call.last_wall
+            if duration >= self.MIN_SAMPLE_FRACTION * self.interval:
+                self._sample(call, cpu, wall)
+            elif call.samples:
+                # merges the short tail into the previous sample, weighted by wall time
+                previous = call.samples[-1] * call.last_duration / 100
+                call.samples[-1] = 100 * (previous + cpu - call.last_cpu) / (call.last_duration + duration)
+        return tuple(call.samples)
+
+    @staticmethod
+    def _sample(call: CpuCall, cpu: float, wall: float):
+        if wall > call.last_wall:
+            call.last_duration = wall - call.last_wall
+            call.samples.append(100 * (cpu - call.last_cpu) / call.last_duration)
+        call.last_cpu, call.last_wall = cpu, wall
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._calls:
+                    self._thread = None
+                    return
+                now = time.perf_counter()
+                for call in self._calls.values():
+                    if call.next_due <= now:
+                        self._sample(call, call.clock(), time.perf_counter())
+                        while call.next_due <= now:  # skips slots missed by a late sampler
+                            call.next_due += self.interval
+                next_due = min(call.next_due for call in self._calls.values())
+            time.sleep(max(next_due - time.perf_counter(), 0.001))
+
+
+CPU_SAMPLER = ThreadCpuSampler(CPU_MEASURMENT_INTERVAL)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=CPU_SAMPLER._reset)
 
 
 class CpuUse(SingleNestValueMetric):
     """
-    CPU use is sampled every 0.1 sec (CPU_MEASURMENT_INTERVAL)
-    For functions faster than this resolution metric might collect useless values.
+    CPU use of the thread executing the function is sampled every 0.1 sec (CPU_MEASURMENT_INTERVAL)
+    by a single sampler shared by all threads (CPU_SAMPLER).
+    Samples are aligned with the call start, the last sample covers the time from the previous sample
+    to the function return (see ThreadCpuSampler). Calls much shorter than the interval record no samples.
+    Threads and processes started by the function are not accounted.
     """
     PRIMARY_REGISTRY = CPUUseRegistry
     PRIMARY_REGISTRY_DEFAULT = CPUMeanUseData.null
 
     def decorator(self, fn):
-        template = fn_name_template(fn)
+        resolve_fn_name = self.key_table.resolver(fn)
 
         @wraps(fn)
         def wrapper(*args, **kwargs):
-            fn_name = template.format(pull_self(args))
-            # setup
-            pid = psutil.Process().pid
-            with multiprocessing.Manager() as manager:
-                flag = manager.Event()
-                flag.clear()
-                q = manager.Queue()
-                # calculate
-                p = multiprocessing.Process(target=cpu_measurment, args=(q, pid, flag))
-                p.start()
+            fn_name = resolve_fn_name(args)
+            call = CPU_SAMPLER.start()
+            try:
                 result = fn(*args, **kwargs)
-                flag.set()
-
-                p.join()
-                m = []
-                while not q.empty():
-                    m.append(q.get())
-                self.registry[fn_name] = self.registry[fn_name].update_from_historical(CPUMeanUseData(1, tuple(m)))
-                return result
+            finally:
+                m = CPU_SAMPLER.stop(call)
+            if m:
+                self.registry[fn_name] = self.registry[fn_name].update_from_historical(CPUMeanUseData(1, m))
+                self.registry.dirty.add(fn_name)
+            return result
         return wrapper
 
     def serialize(self):
@@ -128,6 +227,7 @@ class MemoryUseRegistry(PerformanceRegistry):
     def purge(self):
         for k in self.keys():
             self[k] = MemoryUseMean.null()
+        self.mark_dirty(self)
 
     def cast(self):
         return {k: tuple(v) for k, v in self.items()}
@@ -136,6 +236,7 @@ class MemoryUseRegistry(PerformanceRegistry):
         validate_other_same_class(self, historical)
         for k, v in historical.items():
             self[k] = self.get(k, MemoryUseMean.null()).update_from_historical(v)
+        self.mark_dirty(historical)
 
 
 def memory_measurment(metrics, pid, flag):
@@ -163,11 +264,11 @@ class MemoryUse(SingleNestValueMetric):
     PRIMARY_REGISTRY_DEFAULT = MemoryUseMean.null
 
     def decorator(self, fn):
-        template = fn_name_template(fn)
+        resolve_fn_name = self.key_table.resolver(fn)
 
         @wraps(fn)
         def wrapper(*args, **kwargs):
-            fn_name = template.format(pull_self(args))
+            fn_name = resolve_fn_name(args)
             # setup
             pid = psutil.Process().pid
             with multiprocessing.Manager() as manager:
@@ -185,6 +286,7 @@ class MemoryUse(SingleNestValueMetric):
                     m.append(q.get())
                 m = calculate_change(m)
                 self.registry[fn_name] = self.registry[fn_name].update_from_historical(MemoryUseMean(1, m))
+                self.registry.dirty.add(fn_name)
                 return result
         return wrapper
 
@@ -1,18 +1,24 @@
+import contextvars
 import datetime
+import inspect
 import time
 from collections import namedtuple, defaultdict
 from functools import wraps
 from math import ceil
 
 import matplotlib.axes
+import numpy as np
+import pandas as pd
 from matplotlib import pyplot as plt
 import matplotlib.ticker as mticker
 
 
 from pandas import Period
 
-from .base_metrics import (DictOfNumericsRegistry, fn_name_template, pull_self, DictOfDictRegistry,
-                           validate_other_same_class, DoubleNestValueMetric, zero, SingleNestValueMetric, fn_name_abbr)
+from .base_metrics import (DictOfNumericsRegistry, DictOfDictRegistry,
+                           validate_other_same_class, DoubleNestValueMetric, zero, SingleNestValueMetric, fn_name_abbr,
+                           factorize_fn_names, as_datetime64, validate_ingest_lengths, Labeler, MAX_LABELS,
+                           DirtyKeysMixin)
 
 PERIODIC_FUNCTIONS = {
     'h': lambda x: Period(x, 'H').hour,
@@ -35,12 +41,73 @@ TIMELINE_FUNCTIONS = {
     'w': lambda x: Period(x, 'D').start_time.strftime('%Y%m%dw%W')
 }
 
+# Period frequencies after which a time stamp function result changes
+BUCKET_FREQUENCIES = {
+    'h': 'H',
+    'm': 'M',
+    'd': 'D',
+    'w': 'D'
+}
+
+# vectorized counterparts of the above - take datetime64 arrays, return int64 arrays
+PERIODIC_BULK_FUNCTIONS = {
+    'h': lambda x: (x.astype('datetime64[h]') - x.astype('datetime64[D]')).astype(np.int64),
+    'm': lambda x: (x.astype('datetime64[M]') - x.astype('datetime64[Y]')).astype(np.int64) + 1,
+    'd': lambda x: (x.astype('datetime64[D]') - x.astype('datetime64[M]')).astype(np.int64) + 1,
+    'w': lambda x: (x.astype('datetime64[D]').astype(np.int64) + 3) % 7  # 1970-01-01 was Thursday
+}
+
+TIMELINE_BULK_UNITS = {
+    'h': 'datetime64[h]',
+    'm': 'datetime64[M]',
+    'd': 'datetime64[D]',
+    'w': 'datetime64[D]'
+}
+
+TIMELINE_BULK_FORMATS = {
+    'h': '%Y%m%dh%H',
+    'm': '%Y%m',
+    'd': '%Y%m%d',
+    'w': '%Y%m%dw%W'
+}
+
+TIMELINE_BULK_FUNCTIONS = {tag: lambda x, unit=unit: x.astype(unit).astype(np.int64)
+                           for tag, unit in TIMELINE_BULK_UNITS.items()}
+
 
 # Periodic -------------------------------
 class PeriodicRegistry(DictOfDictRegistry):
     pass
 
 
+class PeriodicHandle:
+    """
+    Pre-bound Periodic/Timeline key for hot loops (see PeriodicBase.handle).
+    The current time bucket is computed once per bucket period, not on each add.
+    """
+    __slots__ = ('metric', 'key', 'time_stamp_function', 'frequency', 'bucket', 'next_bucket')
+
+    def __init__(self, metric, key: str):
+        self.metric = metric
+        self.key = key
+        self.time_stamp_function = metric.TIME_STAMP_FUNCTIONS[metric.TIME_TAG]
+        self.frequency = BUCKET_FREQUENCIES[metric.TIME_TAG]
+        self.bucket = None
+        self.next_bucket = datetime.datetime.min
+
+    def add(self, n: int = 1, timestamp: datetime.datetime = None):
+        if timestamp is None:
+            now = datetime.datetime.now()
+            if now >= self.next_bucket:
+                self.bucket = self.time_stamp_function(now)
+                self.next_bucket = (Period(now, self.frequency) + 1).start_time.to_pydatetime()
+            bucket = self.bucket
+        else:
+            bucket = self.time_stamp_function(timestamp)
+        self.metric.count_table(self.key)[bucket] += n
+        self.metric.registry.dirty.add(self.key)
+
+
 class PeriodsTable(DictOfNumericsRegistry):
     pass
 
@@ -55,17 +122,18 @@ class PeriodicBase(DoubleNestValueMetric):
     SECONDARY_REGITRY_DEFAULT = zero
     TIME_TAG = 'h'
     TIME_STAMP_FUNCTIONS = PERIODIC_FUNCTIONS
+    BULK_TIME_STAMP_FUNCTIONS = PERIODIC_BULK_FUNCTIONS
 
     def __call__(self, fn):
         return self.decorator(fn)
 
     def decorator(self, fn):
-        template = fn_name_template(fn)
+        resolve_fn_name = self.key_table.resolver(fn)
 
         @wraps(fn)
         def wrapper(*args, **kwargs):
 
-            fn_name = template.format(pull_self(args))
+            fn_name = resolve_fn_name(args)
             try:
                 count_table = self.registry[fn_name]
             except KeyError:
@@ -73,11 +141,61 @@ class PeriodicBase(DoubleNestValueMetric):
                     self.__class__.SECONDARY_REGISTRY(self.__class__.SECONDARY_REGITRY_DEFAULT)
             time_tag = self.__class__.TIME_TAG
             count_table[self.__class__.TIME_STAMP_FUNCTIONS[time_tag](datetime.datetime.now())] += 1
+            self.registry.dirty.add(fn_name)
 
             return fn(*args, **kwargs)
 
         return wrapper
 
+    def count_table(self, fn_name: str):
+        try:
+            return self.registry[fn_name]
+        except KeyError:
+            count_table = self.registry[fn_name] = \
+                self.__class__.SECONDARY_REGISTRY(self.__class__.SECONDARY_REGITRY_DEFAULT)
+            return count_table
+
+    def handle(self, key: str) -> PeriodicHandle:
+        """
+        Returns a handle recording calls under key without decorating a function:
+            requests = stats.Hourly.handle('module.requests')
+            requests.add()
+        """
+        return PeriodicHandle(self, self.key_table.intern(key))
+
+    def ingest(self, fn_names, timestamps):
+        """
+        Bulk adds calls to the registry (eg. backfilling from access logs).
+        fn_names: array of function names (one per timestamp) or a single name for all timestamps.
+        timestamps: array of naive local times (datetime, numpy.datetime64 or ISO strings)
+        - the same values datetime.datetime.now() gives the decorator. Missing (NaT / None) timestamps are skipped.
+        Bucketing is vectorized, so the registry is touched once per (function, bucket).
+        """
+        timestamps = as_datetime64(timestamps)
+        codes, fn_names = factorize_fn_names(fn_names, len(timestamps))
+        validate_ingest_lengths(codes, timestamps)
+        valid = ~np.isnat(timestamps)  # missing (NaT / None) timestamps are skipped
+        if not valid.all():
+            codes, timestamps = codes[valid], timestamps[valid]
+
+        buckets = self.__class__.BULK_TIME_STAMP_FUNCTIONS[self.__class__.TIME_TAG](timestamps)
+        bucket_codes, buckets = pd.factorize(buckets)
+        n_buckets = len(buckets)
+        pair_codes, pairs = pd.factorize(codes * n_buckets + bucket_codes)
+        counts = np.bincount(pair_codes, minlength=len(pairs))
+        keys = self.bulk_keys(buckets)
+
+        for pair, n in zip(pairs.tolist(), counts.tolist()):
+            fn_name = self.key_table.intern(fn_names[pair // n_buckets])
+            self.count_table(fn_name)[keys[pair % n_buckets]] += n
+            self.registry.dirty.add(fn_name)
+        return self
+
+    @classmethod
+    def bulk_keys(cls, buckets):
+        """translates BULK_TIME_STAMP_FUNCTIONS output into the registry keys"""
+        return buckets.tolist()
+
     def plot(self):
         k = len(self.registry)
         fig, axs = plt.subplots(k)
@@ -151,8 +269,16 @@ class TimelineBase(PeriodicBase):
     SECONDARY_REGISTRY = TimelineTable
     SECONDARY_REGITRY_DEFAULT = zero
     TIME_STAMP_FUNCTIONS = TIMELINE_FUNCTIONS
+    BULK_TIME_STAMP_FUNCTIONS = TIMELINE_BULK_FUNCTIONS
     TIME_TAG = 'h'
 
+    @classmethod
+    def bulk_keys(cls, buckets):
+        unit = TIMELINE_BULK_UNITS[cls.TIME_TAG]
+        fmt = TIMELINE_BULK_FORMATS[cls.TIME_TAG]
+        moments = buckets.astype(unit).astype('datetime64[s]').tolist()
+        return [m.strftime(fmt) for m in moments]
+
     @classmethod
     def load(cls, d):
         """
@@ -188,7 +314,7 @@ class PerformanceData(namedtuple('PerformanceData', field_names=('n', 'total', '
         validate_other_same_class(self, historical)
         n: int = self.n + historical.n
         total: int = self.total + historical.total
-        mean: float = total / n
+        mean: float = total / n if n else 0
         return PerformanceData(n, total, mean)
 
     @classmethod
@@ -196,13 +322,14 @@ class PerformanceData(namedtuple('PerformanceData', field_names=('n', 'total', '
         return PerformanceData(0, 0, 0)
 
 
-class PerformanceRegistry(defaultdict):
+class PerformanceRegistry(DirtyKeysMixin, defaultdict):
     def __repr__(self):
         return f'{self.__class__.__name__}: {self.cast()}'
 
     def purge(self):
         for k in self.keys():
             self[k] = PerformanceData.null()
+        self.mark_dirty(self)
 
     def cast(self):
         return {k: tuple(v) for k, v in self.items()}
@@ -211,36 +338,118 @@ class PerformanceRegistry(defaultdict):
         validate_other_same_class(self, historical)
         for k, v in historical.items():
             self[k] = self.get(k, PerformanceData.null()).update_from_historical(v)
+        self.mark_dirty(historical)
+
+
+class PerformanceTimer:
+    """
+    Reusable context manager timing a block under a key (see Performance.timer).
+    Not reentrant - use one timer per thread.
+    """
+    __slots__ = ('registry', 'key', 't0', 'mark_dirty')
+
+    def __init__(self, registry, key: str):
+        self.registry = registry
+        self.key = key
+        self.t0 = None
+        self.mark_dirty = registry.dirty.add
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.add(time.perf_counter() - self.t0)
+        return False
+
+    def add(self, total: float, n: int = 1):
+        """records n calls, that took total seconds"""
+        old = self.registry[self.key]
+        n = old.n + n
+        total = old.total + total
+        self.registry[self.key] = PerformanceData(n, total, total / n if n else 0)
+        self.mark_dirty(self.key)
 
 
 class Performance(SingleNestValueMetric):
     """
     counts performance metric
+    In tracing mode (see Stats.trace) calls are also recorded in the call_tree (CallTree metric).
     """
     PRIMARY_REGISTRY = PerformanceRegistry
     PRIMARY_REGISTRY_DEFAULT = PerformanceData.null
 
     def __init__(self,):
         super().__init__()
-        self._registry = PerformanceRegistry(PerformanceData.null)
+        self._registry = PerformanceRegistry(PerformanceData.null).track()
+        self.call_tree = None
 
     def decorator(self, fn):
-        template = fn_name_template(fn)
+        resolve_fn_name = self.key_table.resolver(fn)
+
+        if inspect.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                fn_name = resolve_fn_name(args)
+                frame = None if self.call_tree is None else self.call_tree.enter(fn_name)
+                t0 = time.perf_counter()
+                try:
+                    result = await fn(*args, **kwargs)
+                finally:
+                    t1 = time.perf_counter() - t0
+                    if frame is not None:
+                        self.call_tree.exit(frame, t1)
+                self.record(fn_name, t1)
+                return result
+            return async_wrapper
 
         @wraps(fn)
         def wrapper(*args, **kwargs):
-            fn_name = template.format(pull_self(args))
-            old = self.registry[fn_name]
+            fn_name = resolve_fn_name(args)
+            if self.call_tree is not None:
+                return self.traced_call(fn_name, fn, args, kwargs)
+            registry = self.registry
+            old = registry[fn_name]
             t0 = time.perf_counter()
             result = fn(*args, **kwargs)
             t1 = time.perf_counter() - t0
             n = old.n + 1
             total = old.total + t1
             mean = total / n
-            self.registry[fn_name] = PerformanceData(n, total, mean)
+            registry[fn_name] = PerformanceData(n, total, mean)
+            registry.dirty.add(fn_name)
             return result
         return wrapper
 
+    def traced_call(self, fn_name, fn, args, kwargs):
+        frame = self.call_tree.enter(fn_name)
+        t0 = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        finally:
+            t1 = time.perf_counter() - t0
+            self.call_tree.exit(frame, t1)
+        self.record(fn_name, t1)
+        return result
+
+    def record(self, fn_name: str, total: float, n: int = 1):
+        old = self.registry[fn_name]
+        n = old.n + n
+        total = old.total + total
+        self.registry[fn_name] = PerformanceData(n, total, total / n if n else 0)
+        self.registry.dirty.add(fn_name)
+
+    def timer(self, key: str) -> PerformanceTimer:
+        """
+        Returns a context manager timing a block under key without decorating a function:
+            timer = stats.Performance.timer('module.block')
+            for item in items:
+                with timer:
+                    ...
+        """
+        return PerformanceTimer(self.registry, self.key_table.intern(key))
+
     def serialize(self):
         return self.registry.cast()
 
@@ -253,4 +462,213 @@ class Performance(SingleNestValueMetric):
         return metric
 
 
-AVAILABLE = (Hours, Days, Weekdays, Months, Hourly, Weekly, Daily, Monthly, Performance)
\ No newline at end of file
+class PerformanceLabelsRegistry(DictOfDictRegistry):
+    pass
+
+
+class PerformanceLabelsTable(PerformanceRegistry):
+    """
+    label -> PerformanceData
+    Purge deletes labels (as DictOfNumericsRegistry does), so purged labels do not count against max_labels.
+    """
+
+    def purge(self):
+        keys = tuple(self.keys())
+        for k in keys:
+            del self[k]
+        self.mark_dirty(keys)
+
+
+class PerformanceLabels(DoubleNestValueMetric):
+    """
+    Performance per label key.
+    labels: callable(args, kwargs, result) returning a tuple of (hashable) labels, eg.:
+        @stats.PerformanceLabels(lambda args, kwargs, result: (kwargs['endpoint'],))
+    max_labels: cardinality cap of a function table, excess labels are recorded under OVERFLOW_LABEL
+    """
+    PRIMARY_REGISTRY = PerformanceLabelsRegistry
+    SECONDARY_REGISTRY = PerformanceLabelsTable
+    SECONDARY_REGITRY_DEFAULT = PerformanceData.null
+
+    def __call__(self, labels, max_labels: int = MAX_LABELS):
+        if not callable(labels):
+            raise ValueError('Invalid decorator use. Declare a callable label extractor.')
+        return self.decorated_namespace(labels, max_labels)
+
+    def decorated_namespace(self, labels, max_labels):
+
+        def decorator(fn):
+            resolve_fn_name = self.key_table.resolver(fn)
+            labeler = Labeler(labels, self.key_table, max_labels)
+
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                t0 = time.perf_counter()
+                result = fn(*args, **kwargs)
+                t1 = time.perf_counter() - t0
+                fn_name = resolve_fn_name(args)
+
+                try:
+                    perf_table = self.registry[fn_name]
+                except KeyError:
+                    perf_table = self.registry[fn_name] = self.__class__.SECONDARY_REGISTRY(self.__class__.SECONDARY_REGITRY_DEFAULT)
+
+                label = labeler(perf_table, args, kwargs, result)
+                old = perf_table[label]
+                n = old.n + 1
+                total = old.total + t1
+                perf_table[label] = PerformanceData(n, total, total / n)
+                self.registry.dirty.add(fn_name)
+                return result
+
+            return wrapper
+        return decorator
+
+    @classmethod
+    def load(cls, d):
+        """
+        this is overwrites the original method because secondary values are PerformanceData
+        """
+        metric = cls()
+        for fn_name, loaded_secondary_registry in d.items():
+            self_secondary_registry = metric.registry[fn_name] = cls.SECONDARY_REGISTRY(cls.SECONDARY_REGITRY_DEFAULT)
+            for label, perfs in loaded_secondary_registry.items():
+                self_secondary_registry[label] = PerformanceData(*perfs)
+        return metric
+
+
+# Call tree ------------------------------------
+CALL_PATH_SEPARATOR = ';'  # collapsed stack format separator
+
+# innermost traced call of the current thread / asyncio task
+CALL_STACK = contextvars.ContextVar('ptbappstats_call_stack', default=None)
+
+
+class CallFrame:
+    __slots__ = ('path', 'parent', 'child_time', 'token')
+
+    def __init__(self, path: str, parent: 'CallFrame'):
+        self.path = path
+        self.parent = parent
+        self.child_time = 0.
+        self.token = None
+
+
+class CallTreeData(namedtuple('CallTreeData', field_names=('n', 'inclusive', 'self_time'))):
+    def update_from_historical(self, historical):
+        validate_other_same_class(self, historical)
+        return CallTreeData(self.n + historical.n,
+                            self.inclusive + historical.inclusive,
+                            self.self_time + historical.self_time)
+
+    @classmethod
+    def null(cls):
+        return CallTreeData(0, 0, 0)
+
+
+class CallTreeRegistry(PerformanceRegistry):
+    """call path (fn names joined with CALL_PATH_SEPARATOR) -> CallTreeData"""
+
+    def purge(self):
+        for k in self.keys():
+            self[k] = CallTreeData.null()
+        self.mark_dirty(self)
+
+    def update_from_historical(self, historical):
+        validate_other_same_class(self, historical)
+        for k, v in historical.items():
+            self[k] = self.get(k, CallTreeData.null()).update_from_historical(v)
+        self.mark_dirty(historical)
+
+
+class CallTree(SingleNestValueMetric):
+    """
+    Records call paths of nested decorated functions, with call counts, inclusive and self times.
+    Call stacks are kept in a context variable, so threads and asyncio tasks are traced separately
+    (a task started inside a traced call is recorded as its child).
+    Self time of calls with concurrent children (eg. asyncio.gather) is clamped at 0.
+    """
+    PRIMARY_REGISTRY = CallTreeRegistry
+    PRIMARY_REGISTRY_DEFAULT = CallTreeData.null
+
+    def __init__(self):
+        super().__init__()
+        self._paths = {}
+
+    def path(self, parent: CallFrame, fn_name: str) -> str:
+        parent_path = None if parent is None else parent.path
+        try:
+            return self._paths[(parent_path, fn_name)]
+        except KeyError:
+            path = fn_name if parent is None else CALL_PATH_SEPARATOR.join((parent_path, fn_name))
+            path = self._paths[(parent_path, fn_name)] = self.key_table.intern(path)
+            return path
+
+    def enter(self, fn_name: str) -> CallFrame:
+        parent = CALL_STACK.get()
+        frame = CallFrame(self.path(parent, fn_name), parent)
+        frame.token = CALL_STACK.set(frame)
+        return frame
+
+    def exit(self, frame: CallFrame, elapsed: float):
+        CALL_STACK.reset(frame.token)
+        if frame.parent is not None:
+            frame.parent.child_time += elapsed
+        old = self.registry[frame.path]
+        self.registry[frame.path] = CallTreeData(old.n + 1,
+                                                 old.inclusive + elapsed,
+                                                 old.self_time + max(elapsed - frame.child_time, 0.))
+        self.registry.dirty.add(frame.path)
+
+    def decorator(self, fn):
+        resolve_fn_name = self.key_table.resolver(fn)
+
+        if inspect.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                frame = self.enter(resolve_fn_name(args))
+                t0 = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    self.exit(frame, time.perf_counter() - t0)
+            return async_wrapper
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            frame = self.enter(resolve_fn_name(args))
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.exit(frame, time.perf_counter() - t0)
+        return wrapper
+
+    def edges(self) -> dict:
+        """(parent, child) -> CallTreeData of the child calls, root calls have parent None"""
+        edges = defaultdict(CallTreeData.null)
+        for path, data in self.registry.items():
+            *parents, child = path.split(CALL_PATH_SEPARATOR)
+            edge = (parents[-1] if parents else None, child)
+            edges[edge] = edges[edge].update_from_historical(data)
+        return dict(edges)
+
+    def collapsed(self, unit: float = 1e-6) -> str:
+        """
+        flamegraph collapsed stack format: one 'path self_time' line per call path,
+        self time in units (microseconds by default)
+        """
+        return '\n'.join(f'{path} {round(data.self_time / unit)}' for path, data in self.registry.items() if data.n)
+
+    def serialize(self):
+        return self.registry.cast()
+
+    @classmethod
+    def load(cls, d):
+        metric = cls()
+        for path, data in d.items():
+            metric.registry[path] = CallTreeData(*data)
+        return metric
+
+
+AVAILABLE = (Hours, Days, Weekdays, Months, Hourly, Weekly, Daily, Monthly, Performance, PerformanceLabels, CallTree)
\ No newline at end of file
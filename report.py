@@ -0,0 +1,176 @@
+"""
+Headless batch report rendering.
+
+Renders plottable metrics (Periodic, Timeline, CpuUse, MemoryUse) into image files,
+without pyplot global state (matplotlib object oriented API on the Agg canvas), so no display is needed.
+Long series are downsampled with LTTB (Largest Triangle Three Buckets),
+functions are split across pages (one file per page) rendered in parallel by a process pool.
+
+Run:
+    python -m ptbappstats.report /path/to/the/dump/file /path/to/report/dir
+"""
+
+import argparse
+import datetime
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from .stats import Stats
+from .metrics.base_metrics import fn_name_abbr
+from .metrics.sys_metrics import CpuUse, MemoryUse, CPU_MEASURMENT_INTERVAL, RSS_MEASURMENT_INTERVAL
+from .metrics.time_metrics import PeriodicBase, TimelineBase, TIMELINE_BULK_UNITS, TIMELINE_BULK_FORMATS
+
+PER_PAGE = 10
+MAX_POINTS = 1000
+MAX_X_TICKS = 12
+AXES_HEIGHT = 2.5  # inches
+SUPTITLE_HEIGHT = 0.5  # inches
+
+
+def lttb(x: np.ndarray, y: np.ndarray, n_out: int):
+    """
+    Largest Triangle Three Buckets downsampling.
+    Keeps the first and last point, and of each bucket the point forming the largest triangle
+    with the previously kept point and the next bucket average.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return x, y
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    kept = np.empty(n_out, dtype=int)
+    kept[0], kept[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = (edges[i + 1], edges[i + 2]) if i + 2 < len(edges) else (n - 1, n)
+        avg_x, avg_y = x[next_start:next_end].mean(), y[next_start:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(area.argmax())
+        kept[i + 1] = a
+    return x[kept], y[kept]
+
+
+def timeline_counts(metric, table: dict):
+    """
+    Returns (bucket keys, counts) of a Timeline table over its whole time range,
+    buckets without calls are filled with 0.
+    """
+    if not table:
+        return [], np.zeros(0)
+    unit = TIMELINE_BULK_UNITS[metric.TIME_TAG]
+    fmt = TIMELINE_BULK_FORMATS[metric.TIME_TAG]
+    buckets = np.array([datetime.datetime.strptime(k, fmt) for k in table], dtype=unit).astype(np.int64)
+    first = buckets.min()
+    counts = np.zeros(buckets.max() - first + 1)
+    np.add.at(counts, buckets - first, np.fromiter(table.values(), dtype=float, count=len(table)))
+    return metric.bulk_keys(np.arange(first, buckets.max() + 1)), counts
+
+
+def metric_series(metric, max_points: int = MAX_POINTS) -> list:
+    """
+    Returns picklable series (dicts) of a metric functions, an empty list for not plottable metrics.
+    """
+    series = []
+    for fn, v in metric.registry.items():
+        s = {'label': fn_name_abbr(fn), 'kind': 'line', 'xticklabels': None}
+        if isinstance(metric, (CpuUse, MemoryUse)):
+            interval = CPU_MEASURMENT_INTERVAL if isinstance(metric, CpuUse) else RSS_MEASURMENT_INTERVAL
+            y = np.asarray(v[1], dtype=float)
+            x = np.arange(len(y)) * interval
+            s.update(xlabel='seconds', ylabel='CPU %' if isinstance(metric, CpuUse) else 'bytes')
+        elif isinstance(metric, TimelineBase):
+            keys, y = timeline_counts(metric, v)
+            x = np.arange(len(y), dtype=float)
+            s.update(xlabel=metric.__class__.__name__.lower(), ylabel='n', xticklabels=keys)
+        elif isinstance(metric, PeriodicBase):
+            keys = sorted(v)
+            y = np.array([v[k] for k in keys], dtype=float)
+            x = np.array(keys, dtype=float)
+            s.update(xlabel=metric.__class__.__name__.lower(), ylabel='n', kind='bar')
+        else:
+            return []
+        if s['kind'] == 'line':
+            x, y = lttb(x, y, max_points)
+        if s['xticklabels'] is not None:
+            step = max(len(x) // MAX_X_TICKS, 1)
+            ticks = x[::step]
+            s['xticklabels'] = (ticks, [s['xticklabels'][int(t)] for t in ticks])
+        s.update(x=x, y=y)
+        series.append(s)
+    return series
+
+
+def render_page(title: str, series: list, path: str) -> str:
+    """renders series into a single file, one axes per function"""
+    height = AXES_HEIGHT * len(series) + SUPTITLE_HEIGHT
+    fig = Figure(figsize=(10, height))
+    FigureCanvasAgg(fig)
+    axs = fig.subplots(len(series), 1, squeeze=False)[:, 0]
+    for ax, s in zip(axs, series):
+        if s['kind'] == 'bar':
+            ax.bar(s['x'], s['y'])
+        else:
+            ax.plot(s['x'], s['y'])
+        if s['xticklabels'] is not None:
+            ticks, labels = s['xticklabels']
+            ax.set_xticks(ticks)
+            ax.set_xticklabels(labels, rotation=30, fontsize='small')
+        ax.set_title(s['label'], fontsize='medium')
+        ax.set_xlabel(s['xlabel'])
+        ax.set_ylabel(s['ylabel'])
+    fig.suptitle(title)
+    fig.tight_layout(rect=(0, 0, 1, 1 - SUPTITLE_HEIGHT / height))  # keeps the suptitle above the first axes
+    fig.savefig(path)
+    return path
+
+
+def render_report(stats, out_dir: str, metrics=None, per_page: int = PER_PAGE, max_points: int = MAX_POINTS,
+                  processes: int = None, fmt: str = 'png') -> list:
+    """
+    stats: Stats instance or dump path (see Stats.read)
+    metrics: metric names to render (default: all plottable metrics)
+    per_page: functions per file
+    max_points: line series are downsampled to max_points
+    processes: process pool size (default: cpu count), 1 renders in the current process
+    Returns rendered file paths.
+    """
+    if not isinstance(stats, Stats):
+        stats = Stats.read(stats)
+    os.makedirs(out_dir, exist_ok=True)
+
+    pages = []
+    for metric_name in metrics or stats.metric_names:
+        series = metric_series(getattr(stats, metric_name), max_points)
+        for page, start in enumerate(range(0, len(series), per_page)):
+            path = os.path.join(out_dir, f'{metric_name}_{page:03d}.{fmt}')
+            pages.append((metric_name, series[start:start + per_page], path))
+
+    processes = processes or os.cpu_count() or 1
+    if processes == 1 or len(pages) < 2:
+        return [render_page(*page) for page in pages]
+    with ProcessPoolExecutor(processes) as executor:
+        return list(executor.map(render_page, *zip(*pages)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ptbappstats.report', description=__doc__.split('\n')[1])
+    parser.add_argument('path', help='dump file path')
+    parser.add_argument('out_dir', help='report directory')
+    parser.add_argument('--metrics', nargs='*', help='metric names to render (default: all plottable)')
+    parser.add_argument('--per-page', type=int, default=PER_PAGE, help='functions per file')
+    parser.add_argument('--max-points', type=int, default=MAX_POINTS, help='line series size after downsampling')
+    parser.add_argument('--processes', type=int, default=None, help='process pool size')
+    parser.add_argument('--format', default='png', help='image format')
+    args = parser.parse_args(argv)
+
+    for path in render_report(args.path, args.out_dir, args.metrics, args.per_page, args.max_points,
+                              args.processes, args.format):
+        print(path)
+
+
+if __name__ == '__main__':
+    main()
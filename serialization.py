@@ -0,0 +1,218 @@
+"""
+Codecs and compressions for dump files.
+
+Codecs:
+    json - stdlib json, streamed to the file object in chunks of function entries
+    orjson - requires orjson
+    msgpack - requires msgpack, streamed one function entry at a time
+Compressions:
+    gzip
+    zstd - requires zstandard
+
+Codecs write registries as they are (no cast() copies).
+write_file streams to a temporary file and replaces the target only once the write succeeded.
+read_file detects compression and codec from the file content.
+"""
+
+import gzip
+import importlib
+import json
+import os
+import shutil
+import uuid
+from itertools import islice
+from numbers import Integral, Real
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def to_builtin(obj):
+    """default hook for codecs that do not take tuple / numpy subclasses"""
+    if isinstance(obj, tuple):
+        return list(obj)
+    if isinstance(obj, Integral):
+        return int(obj)
+    if isinstance(obj, Real):
+        return float(obj)
+    if hasattr(obj, 'registry'):  # Metric
+        return obj.registry
+    raise TypeError(f'Object of type {obj.__class__.__name__} is not serializable')
+
+
+class Codec:
+    """
+    Base class
+    """
+    NAME = ''
+    DEPENDENCY = None  # optional module the codec imports
+
+    def dump(self, data: dict, f) -> None:
+        """writes data to a binary file object"""
+        ...
+
+    def loads(self, b: bytes) -> dict:
+        ...
+
+    @classmethod
+    def detect(cls, head: bytes) -> bool:
+        """True if the (decompressed) content starting with head was written with this codec"""
+        ...
+
+
+class JsonCodec(Codec):
+    NAME = 'json'
+    CHUNK_SIZE = 1024
+
+    def __init__(self, encoder_cls=json.JSONEncoder):
+        self.encoder_cls = encoder_cls
+
+    def iterencode(self, data: dict):
+        """
+        yields the json document in chunks of up to CHUNK_SIZE function entries,
+        each chunk is encoded by the (fast) one shot encoder
+        """
+        encode = self.encoder_cls().encode
+        yield '{'
+        for i, (metric_name, metric_data) in enumerate(data.items()):
+            yield (', ' if i else '') + encode(str(metric_name)) + ': '
+            if not isinstance(metric_data, dict):
+                yield encode(metric_data)
+                continue
+            yield '{'
+            items = iter(metric_data.items())
+            separator = ''
+            while True:
+                chunk = dict(islice(items, self.CHUNK_SIZE))
+                if not chunk:
+                    break
+                yield separator + encode(chunk)[1:-1]
+                separator = ', '
+            yield '}'
+        yield '}'
+
+    def dump(self, data, f):
+        for chunk in self.iterencode(data):
+            f.write(chunk.encode('utf-8'))
+
+    def loads(self, b):
+        try:
+            import orjson
+        except ImportError:
+            return json.loads(b)
+        return orjson.loads(b)
+
+    @classmethod
+    def detect(cls, head):
+        return head.lstrip()[:1] in (b'{', b'')
+
+
+class OrjsonCodec(JsonCodec):
+    NAME = 'orjson'
+    DEPENDENCY = 'orjson'
+
+    def dump(self, data, f):
+        import orjson
+        f.write(orjson.dumps(data, default=to_builtin, option=orjson.OPT_NON_STR_KEYS))
+
+
+class MsgpackCodec(Codec):
+    NAME = 'msgpack'
+    DEPENDENCY = 'msgpack'
+
+    def dump(self, data, f):
+        import msgpack
+        packer = msgpack.Packer(default=to_builtin)
+        f.write(packer.pack_map_header(len(data)))
+        for metric_name, metric_data in data.items():
+            f.write(packer.pack(metric_name))
+            if not isinstance(metric_data, dict):
+                f.write(packer.pack(metric_data))
+                continue
+            f.write(packer.pack_map_header(len(metric_data)))
+            for fn, v in metric_data.items():
+                f.write(packer.pack(fn))
+                f.write(packer.pack(v))
+
+    def loads(self, b):
+        import msgpack
+        return msgpack.unpackb(b, strict_map_key=False)
+
+    @classmethod
+    def detect(cls, head):
+        # fixmap, map 16, map 32
+        return bool(head) and (0x80 <= head[0] <= 0x8f or head[0] in (0xde, 0xdf))
+
+
+CODECS = {codec.NAME: codec for codec in (JsonCodec, OrjsonCodec, MsgpackCodec)}
+
+
+def get_codec(name: str) -> Codec:
+    try:
+        return CODECS[name]()
+    except KeyError:
+        raise ValueError(f'Unknown codec: {name}. Available: {tuple(CODECS)}')
+
+
+def get_compressor(compression: str = None):
+    """
+    Returns a callable wrapping a binary file object into a compressed writer.
+    Validates compression and imports optional compressors, so it is called before the target file is opened.
+    """
+    if compression is None:
+        return lambda f: f
+    if compression == 'gzip':
+        return lambda f: gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6)
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().stream_writer
+    raise ValueError(f'Unknown compression: {compression}. Available: gzip, zstd')
+
+
+def decompress(b: bytes) -> bytes:
+    if b.startswith(GZIP_MAGIC):
+        return gzip.decompress(b)
+    if b.startswith(ZSTD_MAGIC):
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj().decompress(b)
+    return b
+
+
+def write_file(path: str, data: dict, codec: str = 'json', compression: str = None, encoder_cls=None):
+    """
+    Streams data to a temporary file in the target directory, then replaces the target with it,
+    so a failed write (unknown compression, missing optional dependency, encoding error,
+    registry changed size while streamed) leaves the previous file intact.
+    """
+    codec = get_codec(codec)
+    if encoder_cls is not None and isinstance(codec, JsonCodec):
+        codec.encoder_cls = encoder_cls
+    compressor = get_compressor(compression)
+    if codec.DEPENDENCY is not None:
+        importlib.import_module(codec.DEPENDENCY)
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    try:
+        with open(tmp_path, 'xb') as f:
+            writer = compressor(f)
+            codec.dump(data, writer)
+            if writer is not f:
+                writer.close()
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def read_file(path: str) -> dict:
+    """detects compression and codec"""
+    with open(path, 'rb') as f:
+        b = decompress(f.read())
+    for codec in (MsgpackCodec, JsonCodec):
+        if codec.detect(b[:16]):
+            return codec().loads(b)
+    raise ValueError(f'Could not detect codec of {path}')
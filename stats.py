@@ -10,31 +10,61 @@ appstat.CountResults
 """
 
 import json
+import sys
+import warnings
 from typing import Any
 from functools import wraps
-from filelock import FileLock
-
 
 from .metrics import sys_metrics, time_metrics, count_metrics
-from .metrics.base_metrics import Metric
+from .metrics.base_metrics import Metric, KeyTable
 
 AVAILABLE_METRICS = {m.__name__: m for m in count_metrics.AVALIABLE}
 AVAILABLE_METRICS.update({m.__name__: m for m in sys_metrics.AVALIABLE})
 AVAILABLE_METRICS.update({m.__name__: m for m in time_metrics.AVAILABLE})
 
-
-def read_json_file(path: str):
-    try:
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.loads(f.read(), cls=StatsDecoder)
-    except FileNotFoundError:
-        raise
+NAMES_SECTION = '__names__'
+
+
+def compact_data(data: dict) -> dict:
+    """
+    Compact dump format: function names (and Timeline bucket keys) are replaced with ids,
+    which index the NAMES_SECTION list.
+    """
+    key_table = KeyTable()
+    compacted = {}
+    for metric_name, metric_data in data.items():
+        metric_cls = AVAILABLE_METRICS.get(metric_name)
+        if metric_cls is not None and issubclass(metric_cls, time_metrics.TimelineBase):
+            metric_data = {fn: {key_table.id(k): n for k, n in table.items()} for fn, table in metric_data.items()}
+        compacted[metric_name] = {key_table.id(fn): v for fn, v in metric_data.items()}
+    return {NAMES_SECTION: key_table.names, **compacted}
+
+
+def expand_data(data: dict) -> dict:
+    """reverses compact_data, data without NAMES_SECTION is returned as it is"""
+    if NAMES_SECTION not in data:
+        return data
+    names = [sys.intern(name) for name in data[NAMES_SECTION]]
+    expanded = {}
+    for metric_name, metric_data in data.items():
+        if metric_name == NAMES_SECTION:
+            continue
+        metric_data = {names[int(fn)]: v for fn, v in metric_data.items()}
+        metric_cls = AVAILABLE_METRICS.get(metric_name)
+        if metric_cls is not None and issubclass(metric_cls, time_metrics.TimelineBase):
+            metric_data = {fn: {names[int(k)]: n for k, n in table.items()} for fn, table in metric_data.items()}
+        expanded[metric_name] = metric_data
+    return expanded
 
 
 class Stats:
 
     def __init__(self):
         self.metric_names = []
+        self.key_table = KeyTable()  # shared by all metrics
+        self._encoder = StatsEncoder()
+        self._serialized = {}  # metric name -> [registry, {key: encoded fragment}, (head, body)]
+        self._serialized_parts = None  # (encoded metrics, whole document) of the last serialize call
 
     @property
     def registry(self):
@@ -47,30 +77,90 @@ class Stats:
             if item in AVAILABLE_METRICS:
                 setattr(self, item, AVAILABLE_METRICS[item]())
                 metric = self.__getattribute__(item)
+                metric.key_table = self.key_table
                 self.metric_names.append(item)
                 return metric
             else:
                 raise
 
-    def serialize(self):
-        registry = {k: dict(metric) for k, metric in self.registry.items()}
-        return json.dumps(registry, cls=StatsEncoder)
+    def cast(self):
+        return {k: registry.cast() for k, registry in self.registry.items()}
+
+    def serialize(self, compact: bool = False):
+        """compact: see compact_data"""
+        if compact:
+            return json.dumps(compact_data(self.cast()), cls=StatsEncoder, separators=(',', ':'))
+        parts = tuple(self._serialize_metric(name) for name in self.metric_names)
+        if self._serialized_parts is None or len(parts) != len(self._serialized_parts[0]) or \
+                any(a is not b for a, b in zip(parts, self._serialized_parts[0])):
+            pieces = ['{']
+            for i, (head, body) in enumerate(parts):
+                pieces.extend((', ' if i else '', head, body, '}'))
+            pieces.append('}')
+            self._serialized_parts = (parts, ''.join(pieces))  # a single copy of the document
+        return self._serialized_parts[1]
+
+    def _serialize_metric(self, metric_name: str) -> str:
+        """
+        Returns (head, body) of the encoded metric, the closing brace is added by serialize.
+        Encoded fragments of registry keys are cached,
+        only keys changed since the previous call (registry.take_dirty) are re-encoded.
+        Untracked registries are encoded in full.
+        """
+        registry = getattr(self, metric_name).registry
+        cached = self._serialized.get(metric_name)
+        if registry.dirty is None or cached is None or cached[0] is not registry:
+            if registry.dirty is not None:
+                registry.take_dirty()
+            fragments = {k: self._encode_fragment(k, v) for k, v in registry.items()}
+            cached = self._serialized[metric_name] = [registry, fragments, None]
+        else:
+            fragments = cached[1]
+            for k in registry.take_dirty():
+                if k in registry:
+                    fragments[k] = self._encode_fragment(k, registry[k])
+                else:
+                    fragments.pop(k, None)
+                cached[2] = None
+            if len(fragments) != len(registry):  # keys created by defaultdict reads are not marked
+                for k in fragments.keys() - registry.keys():
+                    del fragments[k]
+                for k in registry.keys() - fragments.keys():
+                    fragments[k] = self._encode_fragment(k, registry[k])
+                cached[2] = None
+        if cached[2] is None:
+            cached[2] = (f'{self._encoder.encode(metric_name)}: {{', ', '.join(fragments.values()))
+        return cached[2]
+
+    def _encode_fragment(self, key, value) -> str:
+        return f'{self._encoder.encode(str(key))}: {self._encoder.encode(value)}'
 
     def dump(self, path, update: bool = True, purge: bool = True):
-        with FileLock(path + '.lock'):
+        """
+        path: file path (storage backend is chosen by extension - see storage.get_storage)
+        or a storage.StorageBackend instance.
+        """
+        from .storage import get_storage
+        storage = get_storage(path)
+        if update and purge and storage.INCREMENTAL:
+            storage.write(self.registry, increment=True)
+            self.purge()
+            return
+        with storage.lock():
             if update:
                 try:
-                    self.update_from_historical(path)
+                    self.update_from_historical(storage)
                 except FileNotFoundError:
                     pass
-            with open(path, 'w', encoding='utf-8') as f:
-                f.write(self.serialize())
+            storage.write(self.registry)
             if purge:
                 self.purge()
 
-    def _load_dumped(self, path: str):
-        j = read_json_file(path)
+    def _load_dumped(self, path, fn_name: str = None, start=None, end=None):
+        from .storage import get_storage
+        self._load_dict(get_storage(path).read(fn_name=fn_name, start=start, end=end))
 
+    def _load_dict(self, j: dict):
         for metric_name, metric_data in j.items():
             if metric_name in AVAILABLE_METRICS:
                 metric_cls = AVAILABLE_METRICS[metric_name]
@@ -80,7 +170,7 @@ class Stats:
             else:
                 pass
 
-    def update_from_historical(self, path: str):
+    def update_from_historical(self, path):
         loaded_stats = Stats()
         loaded_stats._load_dumped(path)
         for metric_name in self.metric_names:  # update owned metrics only
@@ -92,9 +182,70 @@ class Stats:
                 pass
         return self
 
+    def trace(self, enable: bool = True):
+        """
+        Tracing mode: Performance decorated calls are also recorded in the CallTree metric,
+        with parent -> child paths, inclusive and self times.
+        """
+        self.Performance.call_tree = self.CallTree if enable else None
+        return self
+
+    def push(self, socket_path: str, fallback_path: str = None) -> bool:
+        """
+        Sends current stats as deltas to the aggregator agent (see agent.py) without blocking.
+        Stats are split into deltas that fit a single datagram (see agent.split_delta).
+        Stats are purged once sent, undelivered deltas are merged back, so the agent never counts them twice.
+        If the agent can not take a delta, stats are dumped to fallback_path (if given),
+        otherwise they are kept for the next push and a RuntimeWarning is issued.
+        Returns True if all deltas were delivered to the agent.
+        Raises ValueError if a single function entry does not fit a datagram.
+        """
+        from .agent import split_delta, send_delta, max_delta_size
+        chunks = split_delta(self.cast(), max_delta_size())
+        self.purge()
+        for i, (_, payload) in enumerate(chunks):
+            if not send_delta(socket_path, payload):
+                undelivered = chunks[i:]
+                break
+        else:
+            return True
+        for data, _ in undelivered:
+            self._merge_dict(data)
+        if fallback_path is not None:
+            self.dump(fallback_path, update=True, purge=True)
+        else:
+            warnings.warn(f'Stats agent at {socket_path} did not take {len(undelivered)} of {len(chunks)} deltas, '
+                          f'stats are kept for the next push.', RuntimeWarning)
+        return False
+
+    def _merge_dict(self, j: dict):
+        """adds loaded data onto metrics (not owned metrics become owned)"""
+        loaded_stats = Stats()
+        loaded_stats._load_dict(j)
+        for metric_name in loaded_stats.metric_names:
+            getattr(self, metric_name).update_from_historical(getattr(loaded_stats, metric_name))
+        return self
+
+    def ingest(self, fn_names, timestamps):
+        """
+        Bulk feeds every owned metric that supports ingestion (see PeriodicBase.ingest, Count.ingest).
+        Metrics must be accessed (eg. stats.Hours) before ingesting, to be owned.
+        """
+        timestamps = time_metrics.as_datetime64(timestamps)
+        for metric_name in self.metric_names:
+            metric = getattr(self, metric_name)
+            if hasattr(metric, 'ingest'):
+                metric.ingest(fn_names, timestamps)
+        return self
+
+    def report(self, out_dir: str, **kwargs) -> list:
+        """renders headless report files - see report.render_report"""
+        from .report import render_report
+        return render_report(self, out_dir, **kwargs)
+
     def send(self, url, method='POST'):
         from requests import Request, Session
-        r = Request(method, url, data=self.registry)
+        r = Request(method, url, data=self.serialize(), headers={'Content-Type': 'application/json'})
         r = r.prepare()
         s = Session()
         resp = s.send(r)
@@ -107,9 +258,13 @@ class Stats:
         return self
 
     @classmethod
-    def read(cls, path):
+    def read(cls, path, fn_name: str = None, start=None, end=None):
+        """
+        fn_name: reads only this function stats
+        start, end: inclusive bucket range (datetime or bucket key) - applies to Timeline metrics only
+        """
         ros = ReadOnlyStats()
-        ros._load_dumped(path)
+        ros._load_dumped(path, fn_name=fn_name, start=start, end=end)
         return ros
 
     def Dump(self, path, update=True, purge=True):
@@ -126,11 +281,25 @@ class Stats:
             return wrapper
         return decorator
 
+    def Push(self, socket_path, fallback_path=None):
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                try:
+                    result = fn(*args, **kwargs)
+                except:
+                    result = None
+                finally:
+                    self.push(socket_path, fallback_path=fallback_path)
+                return result
+            return wrapper
+        return decorator
+
     def __getitem__(self, item):
         return self.registry[item]
 
     def __repr__(self):
-        return f'{self.__class__.__name__}: {self.registry}'
+        return f'{self.__class__.__name__}: {self.serialize()}'
 
 
 class ReadOnlyStats(Stats):
@@ -0,0 +1,285 @@
+"""
+Storage backends for Stats.dump, Stats.read and Stats.update_from_historical.
+
+FileStorage - a single file with any codec and compression (see serialization).
+JsonStorage - the original single json file.
+SQLiteStorage - one row per (metric, function, bucket), plus a marker row per written metric (METRIC_MARKER).
+    Dumps (update=True, purge=True) are a single transaction of increment upserts,
+    reads query a function or a time range through indexes.
+
+get_storage(path) picks the backend, codec and compression by file extensions
+(see SQLITE_EXTENSIONS, CODEC_EXTENSIONS, COMPRESSION_EXTENSIONS).
+"""
+
+import os
+import pathlib
+import sqlite3
+from contextlib import closing
+
+from filelock import FileLock
+
+from .stats import AVAILABLE_METRICS, StatsEncoder, compact_data, expand_data
+from .serialization import read_file, write_file
+from .metrics.base_metrics import DoubleNestValueMetric
+from .metrics.time_metrics import Performance, TimelineBase, CallTree, PerformanceLabels
+from .metrics.sys_metrics import CpuUse, MemoryUse
+
+SQLITE_EXTENSIONS = ('.sqlite', '.sqlite3', '.db')
+ROW_FIELD_SEPARATOR = ':'  # bucket = label + separator + field, for tables of tuples
+METRIC_MARKER = ''  # fn (and bucket) of the row stored for each written metric, so empty metrics are read back
+CODEC_EXTENSIONS = {'.msgpack': 'msgpack', '.mpk': 'msgpack'}
+COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.zst': 'zstd'}
+
+
+def timeline_bound(metric_cls, bound):
+    """translates a datetime bound into the metric bucket key, str bounds are used as they are"""
+    if bound is None or isinstance(bound, str):
+        return bound
+    return metric_cls.TIME_STAMP_FUNCTIONS[metric_cls.TIME_TAG](bound)
+
+
+def filter_data(data: dict, fn_name: str = None, start=None, end=None) -> dict:
+    """
+    Filters dumped data by function name and (Timeline metrics only) by bucket range.
+    Bounds are inclusive. Metrics left empty by a filter are dropped, unfiltered data is returned as it is.
+    """
+    filtered = {}
+    for metric_name, metric_data in data.items():
+        if fn_name is not None:
+            metric_data = {fn: v for fn, v in metric_data.items() if fn == fn_name}
+        metric_cls = AVAILABLE_METRICS.get(metric_name)
+        if metric_cls is not None and issubclass(metric_cls, TimelineBase) and (start, end) != (None, None):
+            lo, hi = timeline_bound(metric_cls, start), timeline_bound(metric_cls, end)
+            metric_data = {fn: {k: n for k, n in table.items()
+                                if (lo is None or k >= lo) and (hi is None or k <= hi)}
+                           for fn, table in metric_data.items()}
+            metric_data = {fn: table for fn, table in metric_data.items() if table}
+        if metric_data or (fn_name, start, end) == (None, None, None):
+            filtered[metric_name] = metric_data
+    return filtered
+
+
+class StorageBackend:
+    """
+    Base class
+    """
+    INCREMENTAL = False  # write(data, increment=True) adds data onto the stored values
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def lock(self):
+        return FileLock(self.path + '.lock')
+
+    def read(self, fn_name: str = None, start=None, end=None) -> dict:
+        """must raise FileNotFoundError if nothing was stored yet"""
+        ...
+
+    def write(self, data: dict, increment: bool = False) -> None:
+        ...
+
+
+class FileStorage(StorageBackend):
+    """
+    A single dump file - see serialization for codecs and compressions.
+    Codec and compression are detected on read.
+    """
+
+    def __init__(self, path: str, codec: str = 'json', compression: str = None, compact: bool = False):
+        """compact: writes the compact format (see stats.compact_data), both formats are read"""
+        super().__init__(path)
+        self.codec = codec
+        self.compression = compression
+        self.compact = compact
+
+    def read(self, fn_name=None, start=None, end=None):
+        return filter_data(expand_data(read_file(self.path)), fn_name, start, end)
+
+    def write(self, data, increment=False):
+        if increment:
+            raise ValueError(f'{self.__class__.__name__} does not support incremental writes.')
+        if self.compact:
+            data = compact_data(data)
+        write_file(self.path, data, codec=self.codec, compression=self.compression, encoder_cls=StatsEncoder)
+
+
+class JsonStorage(FileStorage):
+
+    def __init__(self, path: str, compact: bool = False):
+        super().__init__(path, codec='json', compact=compact)
+
+
+# SQLite -----------------------------------
+def row_kind(metric_cls) -> str:
+    if issubclass(metric_cls, PerformanceLabels):
+        return 'performance_table'
+    if issubclass(metric_cls, DoubleNestValueMetric):
+        return 'table'
+    if issubclass(metric_cls, Performance):
+        return 'performance'
+    if issubclass(metric_cls, CallTree):
+        return 'call_tree'
+    if issubclass(metric_cls, (CpuUse, MemoryUse)):
+        return 'means'
+    return 'value'
+
+
+def to_rows(metric_name: str, metric_data: dict):
+    """
+    yields additive (fn, bucket, value) rows
+    means are stored as n * mean, so that rows can be summed up
+    """
+    kind = row_kind(AVAILABLE_METRICS[metric_name])
+    for fn, v in metric_data.items():
+        if kind == 'table':
+            for bucket, n in v.items():
+                yield fn, str(bucket), n
+        elif kind == 'performance_table':
+            for label, (n, total, _) in v.items():
+                yield fn, f'{label}{ROW_FIELD_SEPARATOR}n', n
+                yield fn, f'{label}{ROW_FIELD_SEPARATOR}total', total
+        elif kind == 'performance':
+            n, total, _ = v
+            yield fn, 'n', n
+            yield fn, 'total', total
+        elif kind == 'call_tree':
+            n, inclusive, self_time = v
+            yield fn, 'n', n
+            yield fn, 'inclusive', inclusive
+            yield fn, 'self_time', self_time
+        elif kind == 'means':
+            n, values = v
+            yield fn, 'n', n
+            for i, value in enumerate(values):
+                yield fn, str(i), n * value
+        else:
+            yield fn, '', v
+
+
+def from_rows(metric_name: str, rows) -> dict:
+    """reverses to_rows, result can be passed to Metric.load"""
+    kind = row_kind(AVAILABLE_METRICS[metric_name])
+    grouped = {}
+    for fn, bucket, value in rows:
+        grouped.setdefault(fn, {})[bucket] = value
+    if kind == 'table':
+        return grouped
+    if kind == 'value':
+        return {fn: buckets[''] for fn, buckets in grouped.items()}
+    if kind == 'performance_table':
+        metric_data = {}
+        for fn, buckets in grouped.items():
+            fields = {}
+            for bucket, value in buckets.items():
+                label, _, field = bucket.rpartition(ROW_FIELD_SEPARATOR)
+                fields.setdefault(label, {})[field] = value
+            metric_data[fn] = {label: (f.get('n', 0), f.get('total', 0), f.get('total', 0) / f['n'] if f.get('n') else 0)
+                               for label, f in fields.items()}
+        return metric_data
+    metric_data = {}
+    for fn, buckets in grouped.items():
+        n = buckets.pop('n', 0)
+        if kind == 'performance':
+            total = buckets.get('total', 0)
+            metric_data[fn] = (n, total, total / n if n else 0)
+        elif kind == 'call_tree':
+            metric_data[fn] = (n, buckets.get('inclusive', 0), buckets.get('self_time', 0))
+        else:
+            values = [buckets[i] / n if n else 0 for i in sorted(buckets, key=int)]
+            metric_data[fn] = (n, tuple(values) or (0,))
+    return metric_data
+
+
+class SQLiteStorage(StorageBackend):
+    INCREMENTAL = True
+    TIMEOUT = 30
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS stats ('
+        'metric TEXT NOT NULL, fn TEXT NOT NULL, bucket TEXT NOT NULL, value NUMERIC NOT NULL, '
+        'PRIMARY KEY (metric, fn, bucket)) WITHOUT ROWID',
+        'CREATE INDEX IF NOT EXISTS stats_bucket ON stats (metric, bucket)',
+        'CREATE INDEX IF NOT EXISTS stats_fn ON stats (fn, metric, bucket)',
+    )
+    UPSERT = ('INSERT INTO stats (metric, fn, bucket, value) VALUES (?, ?, ?, ?) '
+              'ON CONFLICT (metric, fn, bucket) DO UPDATE SET value = value + excluded.value')
+    INSERT = 'INSERT OR REPLACE INTO stats (metric, fn, bucket, value) VALUES (?, ?, ?, ?)'
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=self.TIMEOUT, isolation_level=None)
+        for statement in self.SCHEMA:
+            connection.execute(statement)
+        return connection
+
+    def connect_read_only(self):
+        """plain read only connection - no schema setup, so reads never write to the database"""
+        uri = pathlib.Path(self.path).resolve().as_uri() + '?mode=ro'
+        return sqlite3.connect(uri, uri=True, timeout=self.TIMEOUT)
+
+    def read(self, fn_name=None, start=None, end=None):
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(self.path)
+        data = {}
+        with closing(self.connect_read_only()) as connection:
+            if connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stats'").fetchone() is None:
+                raise FileNotFoundError(self.path)
+            for metric_name, metric_cls in AVAILABLE_METRICS.items():
+                query = 'SELECT fn, bucket, value FROM stats WHERE metric = ?'
+                params = [metric_name]
+                if fn_name is not None:
+                    query += ' AND fn = ?'
+                    params.append(fn_name)
+                if issubclass(metric_cls, TimelineBase):
+                    lo, hi = timeline_bound(metric_cls, start), timeline_bound(metric_cls, end)
+                    if lo is not None:
+                        query += ' AND bucket >= ?'
+                        params.append(lo)
+                    if hi is not None:
+                        query += ' AND bucket <= ?'
+                        params.append(hi)
+                rows = connection.execute(query, params).fetchall()
+                metric_rows = [row for row in rows if row[0] != METRIC_MARKER]
+                # as filter_data: metrics left empty by a filter are dropped, unfiltered empty metrics are kept
+                if metric_rows or (len(rows) > len(metric_rows) and (fn_name, start, end) == (None, None, None)):
+                    data[metric_name] = from_rows(metric_name, metric_rows)
+        return data
+
+    def write(self, data, increment=False):
+        rows = ((metric_name, fn, bucket, value)
+                for metric_name, metric_data in data.items() if metric_name in AVAILABLE_METRICS
+                for fn, bucket, value in ((METRIC_MARKER, METRIC_MARKER, 0), *to_rows(metric_name, metric_data)))
+        with closing(self.connect()) as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                if increment:
+                    connection.executemany(self.UPSERT, rows)
+                else:
+                    connection.execute('DELETE FROM stats')
+                    connection.executemany(self.INSERT, rows)
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+
+
+def get_storage(path) -> StorageBackend:
+    if isinstance(path, StorageBackend):
+        return path
+    root, ext = os.path.splitext(path)
+    compression = COMPRESSION_EXTENSIONS.get(ext.lower())
+    if compression is not None:
+        root, ext = os.path.splitext(root)
+    ext = ext.lower()
+    if ext in SQLITE_EXTENSIONS and compression is None:
+        return SQLiteStorage(path)
+    return FileStorage(path, codec=CODEC_EXTENSIONS.get(ext, 'json'), compression=compression)
+
+
+def json_to_sqlite(json_path: str, sqlite_path: str):
+    """imports a json dump file into sqlite storage (overwrites)"""
+    SQLiteStorage(sqlite_path).write(JsonStorage(json_path).read())
+
+
+def sqlite_to_json(sqlite_path: str, json_path: str):
+    """exports sqlite storage into a json dump file (overwrites)"""
+    JsonStorage(json_path).write(SQLiteStorage(sqlite_path).read())